@@ -12,86 +12,378 @@
 #    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
+# cython: language_level=3
 '''
     nfvo_packager.reader
     ~~~~~~~~~~~~~~~~~~~~
     CSAR interface for reading CSAR packages
 '''
 
+import codecs
 import logging
 import os
-from shutil import rmtree
-from glob import glob
-from tempfile import mkstemp, mkdtemp
+import posixpath
+import threading
+from contextlib import contextmanager
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor
+from collections import ChainMap, OrderedDict
+from collections.abc import Mapping
+from copy import deepcopy
+from shutil import copyfileobj
+from fnmatch import fnmatchcase
+from tempfile import mkstemp, TemporaryDirectory
 import mimetypes
 import hashlib
+import hmac
+import json
 from base64 import b64decode
 from pprint import pformat
 import zipfile
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
 
 from nfvo_packager import constants
 
-logging.basicConfig(level=logging.DEBUG)
+# Maximum number of parsed YAML documents kept in memory
+YAML_CACHE_SIZE = 64
+_YAML_CACHE = OrderedDict()
+_YAML_CACHE_LOCK = threading.Lock()
+
+
+def _parse_yaml_cached(stream, key=None):
+    '''
+        Parses a YAML document, reusing the result of a previous parse
+        of identical content. The returned object is shared with the
+        cache and must be copied before being mutated or handed out.
+
+    :param stream: Raw YAML document (bytes) or a binary file object.
+        File objects are only read on a cache miss.
+    :param key: Cache key identifying the document contents. Required
+        for file objects; defaults to a digest of `stream` for bytes.
+    :returns: Parsed YAML data
+    '''
+    if key is None:
+        key = hashlib.blake2b(stream, digest_size=16).digest()
+    with _YAML_CACHE_LOCK:
+        if key in _YAML_CACHE:
+            _YAML_CACHE.move_to_end(key)
+            return _YAML_CACHE[key]
+    # Parse outside of the lock; concurrent misses may parse twice
+    data = yaml.load(stream, Loader=YAMLLoader)
+    with _YAML_CACHE_LOCK:
+        _YAML_CACHE[key] = data
+        if len(_YAML_CACHE) > YAML_CACHE_SIZE:
+            _YAML_CACHE.popitem(last=False)
+    return data
+
+
+def _parse_meta(blob):
+    '''
+        Parses the flat "Key: Value" header of a TOSCA.meta file without
+        going through the YAML parser. Scanning stops at the first line
+        using other YAML constructs (nesting, quoting, trailing comments,
+        ...); that line and everything after it is left for a YAML parse.
+
+    :param bytes blob: Raw TOSCA.meta contents
+    :returns: Tuple of the header dict and the remaining (unparsed) bytes,
+        or (None, None) if the file must be parsed as YAML as a whole
+    '''
+    # A byte order mark is not part of the first key (YAML skips it too)
+    if blob.startswith(codecs.BOM_UTF8):
+        blob = blob[len(codecs.BOM_UTF8):]
+    metadata = dict()
+    offset = 0
+    for line in blob.splitlines(True):
+        if line.strip() and not line.startswith(b'#'):
+            key, sep, value = line.partition(b':')
+            value = value.strip()
+            if line[:1].isspace():
+                return None, None
+            if not sep or not value or \
+               line[:1] in b'-?\'"[{&*!|>%@`' or \
+               value[:1] in b'\'"[{&*!|>%@`' or b' #' in value:
+                return metadata, blob[offset:]
+            metadata[key.strip().decode('utf-8')] = value.decode('utf-8')
+        offset += len(line)
+    return metadata, None
+
+
+# Metadata validation rules: (key, expected value). Every key must be
+# defined with a non-empty value; if an expected value is set, the value
+# must match it (as a string).
+_META_FILE_SCHEMA = (
+    (constants.META_FILE_VERSION_KEY, '1.0'),
+    (constants.META_CSAR_VERSION_KEY, '1.1'),
+    (constants.META_CREATED_BY_KEY, None),
+    (constants.META_ENTRY_DEFINITIONS_KEY, None)
+)
+_META_INLINE_SCHEMA = (
+    (constants.META_TMPL_VERSION_KEY, '1.1'),
+    (constants.META_TMPL_AUTHOR_KEY, None),
+    (constants.META_TMPL_NAME_KEY, None)
+)
+
+
+def _validate_metadata_schema(metadata, schema):
+    '''
+        Validates metadata against a table of validation rules
+
+    :param dict metadata: Metadata to validate
+    :param tuple schema: Tuple of (key, expected value) rules
+    '''
+    # YAML may have produced a scalar or a list instead of a mapping
+    if not isinstance(metadata, Mapping):
+        raise RuntimeError('Metadata must be a "key: value" mapping')
+    for key, expected in schema:
+        value = metadata.get(key)
+        if not value:
+            raise RuntimeError('Missing metadata "%s"' % key)
+        if expected is not None and str(value) != expected:
+            raise RuntimeError('Metadata "%s" must be %s' % (key, expected))
+
+
+# Side-cache of validated metadata, keyed by CSAR path, mtime, size and
+# member index.
+# Bump the header version whenever the cached format changes.
+METADATA_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'nfvo_packager')
+METADATA_CACHE_HEADER = 'nfvo-packager-metadata 1'
+
+# Size of the buffer used to write remote CSARs to disk
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+# Remote CSAR (connect, read) timeouts, in seconds
+DOWNLOAD_TIMEOUT = (5, 30)
+# Shared HTTP session, so repeated downloads reuse pooled connections
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+# Size of the buffer used to copy archive members to disk
+EXTRACT_BUFFER_SIZE = 1 << 20
+# Archives with fewer members than this are extracted sequentially
+EXTRACT_PARALLEL_THRESHOLD = 4
+_EXTRACT_BUFFERS = threading.local()
+
+
+def _member_name(filename):
+    '''
+        Sanitizes an archive member name the same way
+        ZipFile.extractall does
+    '''
+    return '/'.join(x for x in os.path.splitdrive(filename)[1].split('/')
+                    if x not in ('', os.path.curdir, os.path.pardir))
+
+
+def _extract_members(zfile, members, dest, bufsize):
+    '''
+        Extracts archive members. Files that fit in `bufsize` are copied
+        with a single read; larger ones are streamed through one
+        preallocated (per-thread) buffer.
+    '''
+    view = None
+    for info in members:
+        path = os.path.join(dest, *_member_name(info.filename).split('/'))
+        if info.is_dir():
+            os.makedirs(path, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not info.file_size:
+            # Nothing to decompress
+            open(path, 'wb').close()
+            continue
+        with zfile.open(info) as src, open(path, 'wb') as dst:
+            if info.file_size <= bufsize:
+                dst.write(src.read())
+                continue
+            if view is None:
+                buf = getattr(_EXTRACT_BUFFERS, 'buf', None)
+                if buf is None or len(buf) != bufsize:
+                    buf = _EXTRACT_BUFFERS.buf = bytearray(bufsize)
+                view = memoryview(buf)
+            while True:
+                size = src.readinto(view)
+                if not size:
+                    break
+                dst.write(view[:size])
+
+
+def _extract_members_from(filename, members, dest, bufsize):
+    '''
+        Opens a private handle to an archive (ZipFile objects are not
+        safe to share between threads) and extracts members from it
+    '''
+    with zipfile.ZipFile(filename) as zfile:
+        _extract_members(zfile, members, dest, bufsize)
+
+
+def _extract_all(zfile, dest, bufsize=EXTRACT_BUFFER_SIZE):
+    '''
+        Extracts every member of an archive. Larger archives are split
+        into size-balanced batches which are decompressed concurrently
+        (zlib releases the GIL while inflating).
+
+    :param zipfile.ZipFile zfile: Open archive to extract
+    :param str dest: Destination directory
+    :param int bufsize: Copy buffer size, in bytes
+    '''
+    # Members sharing a name would race each other for the same path
+    # in different workers; like extractall, the last one wins
+    members = list(dict(
+        (_member_name(x.filename), x) for x in zfile.infolist()).values())
+    workers = min(8, os.cpu_count() or 1)
+    if workers < 2 or not zfile.filename or \
+       len(members) < EXTRACT_PARALLEL_THRESHOLD:
+        _extract_members(zfile, members, dest, bufsize)
+        return
+    batches = [list() for _ in range(workers)]
+    for idx, info in enumerate(sorted(members, reverse=True,
+                                      key=lambda x: x.compress_size)):
+        batches[idx % workers].append(info)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_extract_members_from, zfile.filename,
+                                   batch, dest, bufsize)
+                   for batch in batches if batch]
+        for future in futures:
+            future.result()
+
+
+# User-defined MIME types currently loaded by mimetypes.init (identified
+# by member name and CRC-32), and the resulting set of known types
+_MIMETYPES = {
+    'key': None,
+    'known': frozenset()
+}
+
+# Size of the blocks artifacts are hashed in
+HASH_BUFFER_SIZE = 1 << 20
+
+
+def _hash_fileobj(fileobj, algo):
+    '''
+        Hashes a binary file object in fixed-size blocks, so memory use
+        does not grow with the file size
+
+    :param fileobj: Binary file object, positioned at the start
+    :param str algo: hashlib algorithm name
+    :returns: hashlib hash object
+    '''
+    # Python 3.11+ hashes into a single reusable buffer
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(fileobj, algo)
+    hasher = hashlib.new(algo)
+    for block in iter(lambda: fileobj.read(HASH_BUFFER_SIZE), b''):
+        hasher.update(block)
+    return hasher
+
+
+def _hash_file(path, algo):
+    '''
+        Hashes a file in fixed-size blocks
+
+    :param str path: Path to the file
+    :param str algo: hashlib algorithm name
+    :returns: hashlib hash object
+    '''
+    with open(path, 'rb', buffering=0) as hfile:
+        return _hash_fileobj(hfile, algo)
 
 
 class CSARReader(object):
     '''
         TOSCA Cloud Service Archive (CSAR) reader. This class
         is a helper for reading, validating, and extracting information
-        from CSAR v1.1 ZIP files (locally or remotely).
+        from CSAR v1.1 ZIP files (locally or remotely). Use it as a
+        context manager (or call `close`) to delete its temporary files
+        as soon as it is no longer needed.
+
+    :param str source: Path or URL of the CSAR package
+    :param bool is_external: True if `source` is a URL
+    :param bool cache: If True, reuse (and store) the validated metadata of
+        local packages in a side-cache keyed by path, mtime, size and the
+        CRC-32 and size of every archive member. A cache hit skips
+        validation, so only enable it for trusted packages.
+    :param tuple digest: Optional (hashlib algorithm, hex digest) pair the
+        package file must match. Remote packages are hashed while they
+        are downloaded.
+
+    :ivar metadata: CSAR metadata. Reader-added keys are layered over the
+        parsed document, which is shared with other readers of the same
+        file and must be treated as read-only.
+    :ivar dict artifacts: CSAR artifacts
+    :ivar str entry_definitions: Entry-Definitions (relative) path
     '''
-    def __init__(self, source, is_external=False, logger=None):
+    def __init__(self, source, is_external=False, logger=None, cache=False,
+                 digest=None):
         self.log = logger or logging.getLogger('csar.reader')
         self.log.debug('CSARReader(%s, %s)', source, is_external)
+        self.metadata = dict()
+        self.artifacts = dict()
+        self.entry_definitions = None
         self.csar = {
             'source': source,
             'external': is_external,
+            'cache': cache,
+            'digest': digest,
             'local': None,
             'destination': None,
+            'tmpdirs': list(),
+            'zfile': None,
+            'lock': threading.Lock(),
             'metadata': None,
-            'artifacts': None
+            'artifacts': None,
+            'entries': dict(),
+            'archive_id': None,
+            'known_types': frozenset(),
+            'content_types': dict(),
+            'entry_yaml': None
         }
-        self._retrieve()
-        self._extract()
-        self._validate()
-
-    def __del__(self):
-        '''
-            Deletes temporary files and folders
-        '''
-        if self.csar.get('local') and \
-           self.csar.get('source') and \
-           self.csar['local'] != os.path.normpath(self.csar['source']) and \
-           os.path.isfile(self.csar['local']):
-            self.log.debug('Removing temporary file: %s', self.csar['local'])
-            os.remove(self.csar['local'])
-        if self.csar.get('destination') and \
-           os.path.isdir(self.csar['destination']):
-            self.log.debug('Removing temporary directory: %s',
-                           self.csar['destination'])
-            rmtree(self.csar['destination'])
+        try:
+            self._retrieve()
+            self._open()
+            if not self._load_cached_metadata():
+                self._validate()
+                self._store_cached_metadata()
+        except Exception:
+            self.close()
+            raise
 
-    @property
-    def has_metadata_file(self):
-        '''Returns True if a metadata file exists'''
-        return os.path.isfile(os.path.join(self.path, constants.META_FILE))
+    def __enter__(self):
+        return self
 
-    @property
-    def metadata(self):
-        '''Returns CSAR metadata'''
-        return self.csar.get('metadata', dict())
+    def __exit__(self, *args):
+        self.close()
 
-    @property
-    def artifacts(self):
-        '''Returns CSAR artifacts'''
-        return self.metadata.get('artifacts', dict())
+    def close(self):
+        '''
+            Closes the CSAR package and deletes temporary files and folders.
+            Temporary folders left open are otherwise deleted once the
+            reader is garbage collected.
+        '''
+        if self.csar['zfile']:
+            self.csar['zfile'].close()
+            self.csar['zfile'] = None
+        while self.csar['tmpdirs']:
+            tmpdir = self.csar['tmpdirs'].pop()
+            self.log.debug('Removing temporary directory: %s', tmpdir.name)
+            tmpdir.cleanup()
 
     @property
     def path(self):
-        '''Returns the root (extracted) CSAR directory path'''
-        return self.csar.get('destination')
+        '''Returns the root CSAR directory path (extracted on first use)'''
+        if self.csar['destination'] is None:
+            self._extract()
+        return self.csar['destination']
+
+    @property
+    def has_metadata_file(self):
+        '''Returns True if a metadata file exists'''
+        return self._has_file(constants.META_FILE)
 
     @property
     def author(self):
@@ -115,70 +407,272 @@ class CSARReader(object):
         '''Returns the CSAR template name'''
         return self.metadata.get(constants.META_TMPL_NAME_KEY)
 
-    @property
-    def entry_definitions(self):
-        '''Returns the Entry-Definitions (relative) path'''
-        return self.metadata.get(constants.META_ENTRY_DEFINITIONS_KEY)
-
     @property
     def entry_definitions_yaml(self):
         '''Returns the TOSCA entry definitions YAML contents'''
-        with open(os.path.join(self.path,
-                               self.entry_definitions), 'r') as mfile:
-            return yaml.load(mfile)
-        return dict()
+        if self.csar['entry_yaml'] is None:
+            self.csar['entry_yaml'] = deepcopy(
+                self._load_yaml(self.entry_definitions))
+        return self.csar['entry_yaml']
+
+    def _has_file(self, name):
+        '''
+            Checks if the CSAR contains a file without touching the
+            filesystem (archive member names are recorded on open)
+
+        :param str name: Path, relative to the CSAR root directory
+        :rtype: boolean
+        '''
+        return posixpath.normpath(name) in self.csar['entries']
+
+    def _glob(self, pattern):
+        '''
+            Matches CSAR files against a glob pattern (following the
+            rules of glob.glob) using the archive member names recorded
+            on open instead of listing directories
+
+        :param str pattern: Pattern, relative to the CSAR root directory
+        :rtype: list
+        :returns: Sorted matching paths, relative to the CSAR root
+        '''
+        parts = pattern.split('/')
+        return sorted(
+            name for name in self.csar['entries']
+            if name.count('/') == len(parts) - 1 and
+            all(fnmatchcase(x, y) and
+                (y.startswith('.') or not x.startswith('.'))
+                for x, y in zip(name.split('/'), parts)))
+
+    @contextmanager
+    def _open_member(self, name):
+        '''
+            Opens a CSAR file for reading straight from the archive,
+            without extracting it. Members may be read concurrently.
+
+        :param str name: Path, relative to the CSAR root directory
+        :returns: Binary file object
+        '''
+        info = self.csar['entries'].get(posixpath.normpath(name))
+        if info is None:
+            raise RuntimeError('Missing CSAR file "%s"' % name)
+        if not self.csar['zfile']:
+            raise RuntimeError('CSAR package is closed')
+        # Opening and closing members updates the archive's (unlocked)
+        # file reference count
+        with self.csar['lock']:
+            mfile = self.csar['zfile'].open(info)
+        try:
+            yield mfile
+        finally:
+            with self.csar['lock']:
+                mfile.close()
+
+    def _load_yaml(self, name):
+        '''
+            Parses a YAML file from the CSAR archive. The archive file
+            identity, plus the CRC-32 and size recorded in its central
+            directory, identify the contents, so the file is only
+            streamed into the parser on a cache miss.
+
+        :param str name: Path, relative to the CSAR root directory
+        :returns: Parsed YAML data (shared; copy before mutating)
+        '''
+        with self._open_member(name) as yfile:
+            return _parse_yaml_cached(yfile, key=self._cache_key(name))
+
+    def _cache_key(self, name):
+        '''
+            Returns a YAML cache key for a CSAR file, built from the
+            archive file identity and the file's archive member entry,
+            or None if it is not a member
+        '''
+        member = posixpath.normpath(name)
+        info = self.csar['entries'].get(member)
+        if info is None:
+            return None
+        return self.csar['archive_id'], member, info.CRC, info.file_size
 
     def _retrieve(self):
         '''
             Fetches a CSAR package (remote or local)
         '''
+        hasher = None
+        if self.csar['digest']:
+            hasher = hashlib.new(self.csar['digest'][0])
         if not self.csar['external']:
             self.log.debug('CSAR is local; normalizing path')
             self.csar['local'] = os.path.normpath(self.csar['source'])
             self.log.debug('CSAR local path is: %s', self.csar['local'])
+            if hasher:
+                self._validate_digest(
+                    _hash_file(self.csar['local'], hasher.name))
             return
         # Get a temporary file
         self.log.debug('Generating temporary file')
-        tmp_hndl, tmp_filename = mkstemp()
+        tmp_filename = os.path.join(self._mkdtemp(), 'package.csar.zip')
         self.log.debug('Temporary file is: %s', tmp_filename)
+        self.csar['local'] = tmp_filename
         # Download the archive
         self.log.debug('Starting remote CSAR download')
-        req = requests.get(self.csar['source'], stream=True)
-        for chunk in req.iter_content(chunk_size=1024):
-            if chunk:
-                os.write(tmp_hndl, chunk)
-        self.log.debug('Remote CSAR downloaded; closing temporary file')
-        os.close(tmp_hndl)
-        # Update the CSAR definition
-        self.csar['local'] = tmp_filename
+        req = _SESSION.get(self.csar['source'], stream=True,
+                           timeout=DOWNLOAD_TIMEOUT,
+                           headers={'Accept-Encoding': 'gzip, deflate'})
+        req.raw.decode_content = True
+        with open(tmp_filename, 'wb', DOWNLOAD_BUFFER_SIZE) as tmp_file:
+            if not hasher:
+                copyfileobj(req.raw, tmp_file, DOWNLOAD_BUFFER_SIZE)
+            else:
+                # Hash the data on its way to disk instead of re-reading it
+                for chunk in iter(
+                        lambda: req.raw.read(DOWNLOAD_BUFFER_SIZE), b''):
+                    hasher.update(chunk)
+                    tmp_file.write(chunk)
+        self.log.debug('Remote CSAR downloaded; temporary file closed')
+        if hasher:
+            self._validate_digest(hasher)
 
-    def _extract(self):
+    def _validate_digest(self, hasher):
         '''
-            Extracts a CSAR package
+            Validates the digest of the CSAR package file
+
+        :param hasher: hashlib hash object fed with the package contents
+        '''
+        self.log.debug('Calculated CSAR %s digest: %s',
+                       hasher.name, hasher.hexdigest())
+        if not hmac.compare_digest(hasher.hexdigest(),
+                                   self.csar['digest'][1].strip().lower()):
+            raise RuntimeError('CSAR digest mismatch')
+
+    def _mkdtemp(self):
+        '''
+            Creates a temporary directory, deleted when the reader is closed
+
+        :returns: Temporary directory path
+        '''
+        self.log.debug('Generating temporary directory')
+        tmpdir = TemporaryDirectory(prefix='csar-')
+        self.csar['tmpdirs'].append(tmpdir)
+        self.log.debug('Temporary directory is: %s', tmpdir.name)
+        return tmpdir.name
+
+    def _open(self):
+        '''
+            Opens a CSAR package and indexes its members. Nothing is
+            extracted until the CSAR directory path is first requested.
         '''
         if not self.csar['local']:
             raise RuntimeError('Missing CSAR file')
-        if not zipfile.is_zipfile(self.csar['local']):
+        # Opening the archive reads its central directory, which
+        # doubles as the ZIP format check
+        try:
+            self.csar['zfile'] = zipfile.ZipFile(self.csar['local'])
+        except (zipfile.BadZipFile, OSError):
             raise RuntimeError('CSAR file is not in ZIP format')
+        self.csar['entries'] = dict(
+            (_member_name(x.filename), x)
+            for x in self.csar['zfile'].infolist() if not x.is_dir())
+        # Identify the opened archive file, so cached parse results of
+        # one package are never reused for another
+        fstat = os.fstat(self.csar['zfile'].fp.fileno())
+        self.csar['archive_id'] = (fstat.st_dev, fstat.st_ino,
+                                   fstat.st_mtime_ns, fstat.st_size)
+
+    def _extract(self):
+        '''
+            Extracts a CSAR package
+        '''
+        if not self.csar['zfile']:
+            raise RuntimeError('CSAR package is closed')
         # Get a temporary directory to use
-        self.log.debug('Generating temporary directory')
-        tmp_dirname = mkdtemp()
-        self.log.debug('Temporary directory is: %s', tmp_dirname)
+        tmp_dirname = self._mkdtemp()
         # Extract ZIP file to temporary directory
         self.log.debug('Extracting CSAR contents')
-        zfile = zipfile.ZipFile(self.csar['local'])
-        zfile.extractall(tmp_dirname)
-        self.log.debug('CSAR contents successfully extracted')
-        # Update the CSAR definition
+        try:
+            _extract_all(self.csar['zfile'], tmp_dirname)
+        except Exception:
+            # Never leave a partial extraction behind for later calls
+            tmpdir = self.csar['tmpdirs'].pop()
+            tmpdir.cleanup()
+            raise
+        # Update the CSAR definition (only once fully extracted)
         self.csar['destination'] = tmp_dirname
+        self.log.debug('CSAR contents successfully extracted')
+
+    def _metadata_cache_path(self):
+        '''
+            Returns the metadata side-cache file path for the CSAR, or
+            None if the side-cache does not apply to it
+        '''
+        if not self.csar['cache'] or self.csar['external']:
+            return None
+        try:
+            fstat = os.stat(self.csar['local'])
+        except OSError:
+            return None
+        hasher = hashlib.blake2b(('%s%s%s' % (
+            os.path.abspath(self.csar['local']),
+            fstat.st_mtime_ns, fstat.st_size)).encode('utf-8'),
+                                 digest_size=16)
+        # Tie the entry to the archive contents, not just the file stat
+        for name, info in sorted(self.csar['entries'].items()):
+            hasher.update(('\0%s\0%s\0%s' % (
+                name, info.CRC, info.file_size)).encode('utf-8'))
+        key = hasher.hexdigest()
+        return os.path.join(METADATA_CACHE_DIR, '%s.json' % key)
+
+    def _load_cached_metadata(self):
+        '''
+            Loads previously validated metadata from the side-cache
+
+        :rtype: boolean
+        :returns: True if the metadata was loaded
+        '''
+        cache_path = self._metadata_cache_path()
+        if not cache_path:
+            return False
+        try:
+            with open(cache_path, 'r') as cfile:
+                if cfile.readline().rstrip('\n') != METADATA_CACHE_HEADER:
+                    self.log.debug('Ignoring outdated metadata cache: %s',
+                                   cache_path)
+                    return False
+                metadata = json.load(cfile)
+        except (OSError, ValueError):
+            return False
+        self.log.debug('Using cached CSAR metadata: %s', cache_path)
+        self._set_metadata(ChainMap(dict(), metadata))
+        self.csar['entry_yaml'] = None
+        return True
+
+    def _store_cached_metadata(self):
+        '''
+            Stores validated metadata in the side-cache (atomically)
+        '''
+        cache_path = self._metadata_cache_path()
+        if not cache_path:
+            return
+        tmp_filename = None
+        try:
+            os.makedirs(METADATA_CACHE_DIR, exist_ok=True)
+            tmp_hndl, tmp_filename = mkstemp(dir=METADATA_CACHE_DIR)
+            with os.fdopen(tmp_hndl, 'w') as cfile:
+                cfile.write(METADATA_CACHE_HEADER + '\n')
+                json.dump(dict(self.metadata), cfile)
+            os.replace(tmp_filename, cache_path)
+            self.log.debug('Stored CSAR metadata cache: %s', cache_path)
+        except (OSError, TypeError, ValueError) as exc:
+            self.log.debug('Could not store CSAR metadata cache: %s', exc)
+            if tmp_filename and os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
 
     def _validate(self):
         '''
             Validates a CSAR package
         '''
-        csar_root = self.csar.get('destination')
-        # Check for a CSAR contents folder
-        if not csar_root or not os.path.isdir(csar_root):
+        # Drop definitions parsed against previous metadata
+        self.csar['entry_yaml'] = None
+        # Check for an open CSAR archive
+        if not self.csar.get('zfile'):
             raise RuntimeError('Missing CSAR contents')
         # Validate metadata
         if self.has_metadata_file:
@@ -195,80 +689,78 @@ class CSARReader(object):
             Validates CSAR metadata file
         '''
         # Check for metadata
-        csar_metafile = os.path.join(self.path, constants.META_FILE)
-        self.log.debug('CSAR metadata file: %s', csar_metafile)
-        # Check the expected files/folders exist
-        if not csar_metafile or not os.path.isfile(csar_metafile):
+        self.log.debug('CSAR metadata file: %s', constants.META_FILE)
+        if not self._has_file(constants.META_FILE):
             raise RuntimeError('Missing CSAR metadata file')
-        # Validate metadata YAML
-        metadata = dict()
-        self.log.debug('Attempting to parse CSAR metadata YAML')
-        with open(csar_metafile, 'r') as mfile:
-            metadata = yaml.load(mfile)
-        self.log.debug('CSAR metadata:\n%s', pformat(metadata))
+        # Parse metadata
+        self.log.debug('Attempting to parse CSAR metadata')
+        with self._open_member(constants.META_FILE) as mfile:
+            blob = mfile.read()
+        metadata, rest = _parse_meta(blob)
+        if rest:
+            # Later keys win, as they would in a single YAML document
+            self.log.debug('Parsing the remaining metadata as YAML')
+            try:
+                rest = _parse_yaml_cached(rest)
+            except yaml.YAMLError:
+                # The tail may not stand alone (e.g. a "..." document
+                # end marker), but the whole file can still be valid
+                rest = None
+            metadata = ChainMap(rest, metadata) \
+                if isinstance(rest, dict) else None
+        if metadata is None:
+            self.log.debug('Metadata is not a flat key/value list; '
+                           'falling back to YAML')
+            metadata = _parse_yaml_cached(
+                blob, key=self._cache_key(constants.META_FILE))
+        if isinstance(metadata, Mapping) and \
+           self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('CSAR metadata:\n%s', pformat(dict(metadata)))
         # Validate metadata specification
-        if constants.META_FILE_VERSION_KEY not in metadata:
-            raise RuntimeError('Missing metadata "%s"' %
-                               constants.META_FILE_VERSION_KEY)
-        if str(metadata[constants.META_FILE_VERSION_KEY]) != '1.0':
-            raise RuntimeError('Metadata "%s" must be 1.0' %
-                               constants.META_FILE_VERSION_KEY)
-        if constants.META_CSAR_VERSION_KEY not in metadata:
-            raise RuntimeError('Missing metadata "%s"' %
-                               constants.META_CSAR_VERSION_KEY)
-        if str(metadata[constants.META_CSAR_VERSION_KEY]) != '1.1':
-            raise RuntimeError('Metadata "%s" must be 1.1' %
-                               constants.META_CSAR_VERSION_KEY)
-        if constants.META_CREATED_BY_KEY not in metadata or \
-           not metadata[constants.META_CREATED_BY_KEY]:
-            raise RuntimeError('Missing metadata "%s"' %
-                               constants.META_CREATED_BY_KEY)
-        if constants.META_ENTRY_DEFINITIONS_KEY not in metadata or \
-           not metadata[constants.META_ENTRY_DEFINITIONS_KEY]:
-            raise RuntimeError('Missing metadata "%s"' %
-                               constants.META_ENTRY_DEFINITIONS_KEY)
-        # Update the CSAR definition
-        self.csar['metadata'] = metadata
+        _validate_metadata_schema(metadata, _META_FILE_SCHEMA)
+        # Update the CSAR definition (overlaying the shared parse result)
+        self._set_metadata(ChainMap(dict(), metadata))
 
     def _validate_metadata_inline(self):
         '''
             Validates CSAR inline metadata
         '''
         # Get a list of all definition files in the root folder
-        root_defs = list()
         self.log.debug('Searching for TOSCA template file with metadata')
-        for ext in ['yaml', 'yml']:
-            root_defs.extend(glob('%s/*.%s' % (self.path, ext)))
+        root_defs = [x for x in self.csar['entries']
+                     if '/' not in x and not x.startswith('.') and
+                     x.rpartition('.')[2].lower() in ('yaml', 'yml')]
         # Make sure there's only one
-        if len(root_defs) is not 1:
+        if len(root_defs) != 1:
             raise RuntimeError(
                 'Exactly 1 YAML file must exist in the CSAR root directory')
         # Validate metadata YAML
         def_data = dict()
         self.log.debug('Attempting to parse CSAR metadata YAML')
-        with open(root_defs[0], 'r') as def_file:
-            def_data = yaml.load(def_file)
+        def_data = self._load_yaml(root_defs[0])
         # Validate metadata specification
+        if not isinstance(def_data, Mapping):
+            raise RuntimeError('Missing metadata section')
         metadata = def_data.get('metadata')
         if not metadata:
             raise RuntimeError('Missing metadata section')
-        if constants.META_TMPL_VERSION_KEY not in metadata:
-            raise RuntimeError('Missing metadata "%s"' %
-                               constants.META_TMPL_VERSION_KEY)
-        if str(metadata[constants.META_TMPL_VERSION_KEY]) != '1.1':
-            raise RuntimeError('Metadata "%s" must be 1.1' %
-                               constants.META_TMPL_VERSION_KEY)
-        if constants.META_TMPL_AUTHOR_KEY not in metadata or \
-           not metadata[constants.META_TMPL_AUTHOR_KEY]:
-            raise RuntimeError('Missing metadata "%s"' %
-                               constants.META_TMPL_AUTHOR_KEY)
-        if constants.META_TMPL_NAME_KEY not in metadata or \
-           not metadata[constants.META_TMPL_NAME_KEY]:
-            raise RuntimeError('Missing metadata "%s"' %
-                               constants.META_TMPL_NAME_KEY)
-        # Update the CSAR definition
-        metadata[constants.META_ENTRY_DEFINITIONS_KEY] = root_defs[0]
+        _validate_metadata_schema(metadata, _META_INLINE_SCHEMA)
+        # Update the CSAR definition (overlaying the shared parse result)
+        self._set_metadata(ChainMap({
+            constants.META_ENTRY_DEFINITIONS_KEY: root_defs[0]
+        }, metadata))
+
+    def _set_metadata(self, metadata):
+        '''
+            Updates the CSAR definition with (validated) metadata and the
+            attributes derived from it
+        '''
         self.csar['metadata'] = metadata
+        self.csar['artifacts'] = metadata.get('artifacts') or dict()
+        self.metadata = metadata
+        self.artifacts = self.csar['artifacts']
+        self.entry_definitions = metadata.get(
+            constants.META_ENTRY_DEFINITIONS_KEY)
 
     def _validate_entry_definitions(self):
         '''
@@ -278,8 +770,7 @@ class CSARReader(object):
         if not self.has_metadata_file:
             self.log.debug('Using inline metadata; skipping...')
             return
-        if not os.path.isfile(os.path.join(self.path,
-                                           self.entry_definitions)):
+        if not self._has_file(self.entry_definitions):
             raise RuntimeError('"%s" points to "%s", but the file '
                                'does not exist' % (
                                    constants.META_ENTRY_DEFINITIONS_KEY,
@@ -290,16 +781,54 @@ class CSARReader(object):
             Validates artifacts
         '''
         self.log.debug('Searching for user-defined MIME types')
-        mtypes = glob(os.path.join(self.path, constants.META_MIMETYPES_GLOB))
-        self.log.debug('Loading %s user-defined MIME types', len(mtypes))
-        mimetypes.init(mtypes or None)
+        mtypes = self._glob(constants.META_MIMETYPES_GLOB)
+        # Identify the MIME type files by contents, not by (temporary) path
+        key = tuple((x, self.csar['entries'][x].CRC) for x in mtypes)
+        if key != _MIMETYPES['key']:
+            self.log.debug('Loading %s user-defined MIME types', len(mtypes))
+            mimetypes.init()
+            for mtype_file in mtypes:
+                self._load_mimetypes(mtype_file)
+            _MIMETYPES['key'] = key
+            _MIMETYPES['known'] = \
+                frozenset(mimetypes.types_map.values()) | \
+                frozenset(mimetypes.common_types.values())
+        self.csar['known_types'] = _MIMETYPES['known']
         self.log.debug('Checking for artifacts')
         if not self.artifacts:
             self.log.debug('No artifacts declared')
             return
-        # Iterate through each artifacts
-        for name, artifact in self.artifacts.iteritems():
-            self._validate_artifact(name, artifact)
+        # Validate artifacts concurrently (hashing releases the GIL)
+        workers = min(8, len(self.artifacts))
+        if workers < 2:
+            for name, artifact in self.artifacts.items():
+                self._validate_artifact(name, artifact)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._validate_artifact, name, artifact)
+                       for name, artifact in self.artifacts.items()]
+            try:
+                # Report the first failure in declaration order
+                for future in futures:
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _load_mimetypes(self, name):
+        '''
+            Registers the MIME types of a mime.types formatted CSAR file,
+            read straight from the archive (as mimetypes.read_mime_types
+            would parse it)
+        '''
+        with self._open_member(name) as mfile:
+            lines = mfile.read().decode('utf-8').splitlines()
+        for line in lines:
+            words = list(takewhile(lambda x: not x.startswith('#'),
+                                   line.split()))
+            for ext in words[1:]:
+                mimetypes.add_type(words[0], '.' + ext)
 
     def _validate_artifact(self, name, artifact):
         '''
@@ -307,35 +836,43 @@ class CSARReader(object):
         '''
         self.log.debug('Validating artifact: %s', name)
         self.log.debug('Checking if artifact file exists')
-        path = os.path.join(self.path, name)
-        if not os.path.isfile(path):
+        if not self._has_file(name):
             raise RuntimeError('Artifact "%s" delcared, but file does '
                                'not exist' % name)
         # Validate the content-type
         if 'content-type' not in artifact:
             raise RuntimeError('Artifact missing "content-type"')
-        self.log.debug('Artifact content-type: %s', artifact['content-type'])
-        tstype = artifact['content-type'].split('/')
-        if len(tstype) < 2:
+        ctype = artifact['content-type']
+        self.log.debug('Artifact content-type: %s', ctype)
+        # Artifacts often share content-types; check each one only once
+        checks = self.csar['content_types'].get(ctype)
+        if checks is None:
+            _, sep, subtype = ctype.rpartition('/')
+            checks = self.csar['content_types'][ctype] = (
+                bool(sep), subtype.startswith('vnd.'),
+                ctype in self.csar['known_types'])
+        is_valid, is_vendor, is_known = checks
+        if not is_valid:
             raise RuntimeError('Artifact content-type must comply with the '
                                '"type/subtype" structure')
-        if not tstype[-1].startswith('vnd.'):
-            self.log.warn('Artifact content-type subtype should start '
-                          'with "vnd."')
+        if not is_vendor:
+            self.log.warning('Artifact content-type subtype should start '
+                             'with "vnd."')
         # Validate content-type as a known MIME type
         self.log.debug('Checking content-type against known MIME types')
-        if len([{x: y} for x, y in mimetypes.types_map.iteritems()
-                if y == artifact['content-type']]) < 1:
-            self.log.warn('Could not match artifact content-type '
-                          'with any known MIME type')
+        if not is_known:
+            self.log.warning('Could not match artifact content-type '
+                             'with any known MIME type')
         # Validate the artifact MIME type against the content-type
         self.log.debug('Checking artifact MIME type against content-type')
-        mtype = mimetypes.guess_type(path)[0]
+        ext = os.path.splitext(name)[1]
+        mtype = mimetypes.types_map.get(ext) or \
+            mimetypes.types_map.get(ext.lower())
         if mtype is None:
-            self.log.warn('Could not match artifact to a known MIME type')
-        if mtype != artifact['content-type']:
-            self.log.warn('Artifact content-type does not match the '
-                          'artifacts MIME type')
+            self.log.warning('Could not match artifact to a known MIME type')
+        if mtype != ctype:
+            self.log.warning('Artifact content-type does not match the '
+                             'artifacts MIME type')
         # Validate the signature / digest
         if 'signature' in artifact:
             sig = artifact['signature']
@@ -349,12 +886,20 @@ class CSARReader(object):
                     'Artifact signature delcared, but no digest was found')
             # Decode base64 encoded digest
             self.log.debug('Decoding base64-encoded artifact digest')
-            digest = b64decode(digest).strip()
-            self.log.debug('Decoded artifact digest: %s', digest)
+            digest = b64decode(digest)
             # Calculate hash of the actual artifact
             self.log.debug('Calculating %s digest of artifact %s', algo, name)
-            adigest = hashlib.new(algo, open(path, 'rb').read()).hexdigest()
-            self.log.debug('Calculated artifact digest: %s', adigest)
+            with self._open_member(name) as afile:
+                hasher = _hash_fileobj(afile, algo)
+            if len(digest) == hasher.digest_size:
+                adigest = hasher.digest()
+            else:
+                # The digest was declared as base64-encoded hex
+                digest = digest.strip().lower()
+                adigest = hasher.hexdigest().encode('ascii')
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug('Calculated artifact digest: %s',
+                               hasher.hexdigest())
             # Compare digests
-            if digest != adigest:
+            if not hmac.compare_digest(digest, adigest):
                 raise RuntimeError('Artifact digest mismatch')
@@ -18,7 +18,9 @@
     CSAR writer interface for building CSAR packages
 '''
 
+import logging
 import os.path
+from pprint import pformat
 from aria import install_aria_extensions
 from aria.tools.utils import create_context
 from aria.consumption import Read, Validate, Template, Inputs, Plan
@@ -28,6 +30,10 @@ from aria.reading import DefaultReaderSource
 from aria.presentation import DefaultPresenterSource
 from aria.presentation.presenter import Presenter
 import ruamel.yaml as yaml
+try:
+    from ruamel.yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from ruamel.yaml import SafeLoader as YAMLLoader
 
 
 META_INF_DIR = 'Meta-Inf'
@@ -36,8 +42,9 @@ MANIFEST_FILE = os.path.join(META_INF_DIR, 'MANIFEST.MF')
 
 class CSARWriter(object):
     '''CSAR writer interface'''
-    def __init__(self, path):
-        if not path or not isinstance(path, basestring):
+    def __init__(self, path, logger=None):
+        self.log = logger or logging.getLogger('csar.write')
+        if not path or not isinstance(path, str):
             raise RuntimeError('Missing or invalid folder path')
         # Ensure the path is absolute
         path = os.path.abspath(path)
@@ -63,11 +70,11 @@ class CSARWriter(object):
             (Read, Validate))
         consumer.append(Template, Plan)
         consumer.consume()
-        print vars(consumer.context)
-        # print consumer.consumers[-1].dump()
-        print context.validation.issues
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('Consumption context:\n%s',
+                           pformat(vars(consumer.context)))
         for issue in context.validation.issues:
-            print vars(issue)
+            self.log.warning('Validation issue: %s', issue)
 
     def validate_meta_inf(self):
         '''Validates the existence of the Meta-Inf folder'''
@@ -87,8 +94,8 @@ class CSARWriter(object):
         # Read in YAML contents
         manifest = None
         with open(os.path.join(self.path, MANIFEST_FILE), 'r') as f_manifest:
-            manifest = yaml.load(f_manifest)
+            manifest = yaml.load(f_manifest, Loader=YAMLLoader)
         if manifest is None:
             raise RuntimeError(
                 'Empty "%s" file format' % MANIFEST_FILE)
-        print 'manifest: %s' % manifest
+        self.log.debug('Manifest: %s', manifest)
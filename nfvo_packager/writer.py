@@ -12,26 +12,250 @@
 #    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
+# cython: language_level=3
 '''
     nfvo_packager.writer
     ~~~~~~~~~~~~~~~~~~~~
     CSAR interface for creating CSAR packages
 '''
 
+import errno
 import logging
+import mmap
 import os
 import shutil
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkstemp, mkdtemp
 from pprint import pformat
 import zipfile
 import yaml
 import hashlib
 import hmac
+try:
+    from yaml import CSafeDumper as YAMLDumper
+except ImportError:
+    from yaml import SafeDumper as YAMLDumper
+try:
+    from isal import isal_zlib
+    from isal.isal_zlib import crc32
+except ImportError:
+    isal_zlib = None
+    from zlib import crc32
 
 from nfvo_packager import constants
 from nfvo_packager.reader import CSARReader
 
-logging.basicConfig(level=logging.DEBUG)
+# Files up to this size are compressed in memory by a pool of workers;
+# larger ones are streamed into the archive
+PARALLEL_DEFLATE_MAX_SIZE = 1 << 26
+# Number of threads reading and compressing files. Small file reads are
+# latency bound, so there are more threads than CPUs to keep several
+# reads in flight while others compress.
+ZIP_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# Maximum amount of (uncompressed) file data read ahead of the writer
+ZIP_PENDING_MAX_SIZE = 1 << 28
+# Size of the buffer used to stream large files (into the archive, or
+# into the signature when they cannot be mapped)
+COPY_BUFFER_SIZE = 1 << 20
+# Extensions of (already compressed) files which are stored as-is,
+# since deflating them again costs time and saves next to nothing
+STORED_EXTENSIONS = frozenset((
+    '.zip', '.jar', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.rpm', '.deb', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3',
+    '.mp4'))
+
+
+# Characters a plain (unquoted) YAML scalar may not start with, and
+# plain scalars a YAML parser would not read back as strings or numbers
+_YAML_INDICATORS = frozenset('-?:,[]{}#&*!|>\'"%@`')
+_YAML_KEYWORDS = frozenset((
+    'y', 'yes', 'n', 'no', 'true', 'false', 'on', 'off', 'null', '~'))
+
+
+def _format_meta(metadata):
+    '''
+        Formats flat metadata as TOSCA.meta "Key: Value" lines without
+        going through the YAML emitter
+
+    :param dict metadata: Metadata to format
+    :rtype: bytes
+    :returns: Formatted metadata, or None if a key or value is not a
+        single-line string that can be written unquoted
+    '''
+    lines = list()
+    for key, value in metadata.items():
+        for text in (key, value):
+            if not isinstance(text, str) or not text or \
+               not text.isprintable() or text != text.strip() or \
+               text[0] in _YAML_INDICATORS or text.endswith(':') or \
+               ': ' in text or ' #' in text or \
+               text.lower() in _YAML_KEYWORDS:
+                return None
+        lines.append('%s: %s\n' % (key, value))
+    return ''.join(lines).encode('utf-8')
+
+
+def _update_from_file(hasher, fileobj):
+    '''
+        Feeds a whole file to a hash object. The file is mapped and
+        handed over in a single call; files which cannot be mapped are
+        read into one reusable buffer instead.
+
+    :param hasher: hashlib (or hmac) hash object
+    :param fileobj: Unbuffered binary file object, positioned at the start
+    '''
+    try:
+        with mmap.mmap(fileobj.fileno(), 0,
+                       access=mmap.ACCESS_READ) as mfile:
+            hasher.update(mfile)
+        return
+    except (OSError, ValueError):
+        pass
+    view = memoryview(bytearray(COPY_BUFFER_SIZE))
+    while True:
+        size = fileobj.readinto(view)
+        if not size:
+            break
+        hasher.update(view[:size])
+
+
+def _walk_files(top, prefix=''):
+    '''
+        Lists the files under a directory, top-down, like os.walk (symbolic
+        links to directories are not followed, unreadable directories are
+        skipped). Archive names are built while descending instead of
+        being derived from each path.
+
+    :param str top: Directory to list
+    :param str prefix: Archive name prefix of the directory's files
+    :returns: Generator of (path, archive name) tuples
+    '''
+    subdirs = list()
+    try:
+        with os.scandir(top) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    yield entry.path, prefix + entry.name
+                elif not entry.is_symlink():
+                    subdirs.append(entry)
+    except OSError:
+        return
+    for entry in subdirs:
+        yield from _walk_files(entry.path, prefix + entry.name + '/')
+
+
+def _deflate_compressor(level):
+    '''
+        Returns a raw deflate compressor, backed by ISA-L (python-isal)
+        when available. ISA-L levels range from 0 to 3, so zlib levels
+        are scaled to match (zlib's default level maps to ISA-L's).
+
+    :param int level: zlib compression level
+    '''
+    if isal_zlib is None or not level:
+        return zlib.compressobj(level, zlib.DEFLATED, -15)
+    if level == zlib.Z_DEFAULT_COMPRESSION:
+        level = isal_zlib.ISAL_DEFAULT_COMPRESSION
+    else:
+        level = min(level, 9) * isal_zlib.ISAL_BEST_COMPRESSION // 9
+    return isal_zlib.compressobj(level, isal_zlib.DEFLATED, -15)
+
+
+def _compress_file(path, compress_type, level):
+    '''
+        Reads and (unless stored) deflates a file. zlib and ISA-L release
+        the GIL while compressing, so files are compressed concurrently.
+
+    :returns: Tuple of (CRC-32, uncompressed size, member data)
+    '''
+    with open(path, 'rb') as src:
+        data = src.read()
+    crc = crc32(data)
+    if compress_type == zipfile.ZIP_STORED:
+        return crc, len(data), data
+    compressor = _deflate_compressor(level)
+    return crc, len(data), compressor.compress(data) + compressor.flush()
+
+
+def _write_compressed(ziph, zinfo, crc, size, data):
+    '''
+        Appends an already compressed member to an archive open for
+        writing. ZipFile has no public interface for this, so this
+        mirrors what ZipFile.writestr does once data is compressed.
+    '''
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    zinfo.flag_bits = 0
+    with ziph._lock:
+        if ziph._seekable:
+            ziph.fp.seek(ziph.start_dir)
+        zinfo.header_offset = ziph.fp.tell()
+        ziph._writecheck(zinfo)
+        ziph._didModify = True
+        ziph.fp.write(zinfo.FileHeader())
+        ziph.fp.write(data)
+        ziph.start_dir = ziph.fp.tell()
+        ziph.filelist.append(zinfo)
+        ziph.NameToInfo[zinfo.filename] = zinfo
+
+
+def _write_file(ziph, zinfo, path):
+    '''
+        Streams a file into an archive open for writing, using a larger
+        buffer than ZipFile.write
+    '''
+    with open(path, 'rb') as src, ziph.open(zinfo, 'w') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def _zip_files(ziph, files):
+    '''
+        Compresses files on a pool of worker threads and writes them to
+        an archive, in order, from the calling thread. Files are
+        compressed with the archive's compression method and level,
+        except for already compressed files, which are stored.
+
+    :param zipfile.ZipFile ziph: Archive open for writing
+    :param list files: List of (path, archive name) tuples
+    '''
+    level = ziph.compresslevel
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    pending = deque()
+    pending_size = 0
+    with ThreadPoolExecutor(max_workers=ZIP_WORKERS) as executor:
+        for path, arcname in files:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo._compresslevel = ziph.compresslevel
+            if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = ziph.compression
+            # Only Deflate is implemented by the workers
+            if zinfo.file_size > PARALLEL_DEFLATE_MAX_SIZE or \
+               zinfo.compress_type not in (zipfile.ZIP_STORED,
+                                           zipfile.ZIP_DEFLATED):
+                while pending:
+                    zinfo_, future = pending.popleft()
+                    _write_compressed(ziph, zinfo_, *future.result())
+                pending_size = 0
+                _write_file(ziph, zinfo, path)
+                continue
+            pending.append((zinfo, executor.submit(
+                _compress_file, path, zinfo.compress_type, level)))
+            pending_size += zinfo.file_size
+            # Bound the amount of file data held in memory
+            while len(pending) > ZIP_WORKERS * 2 or \
+                    pending_size > ZIP_PENDING_MAX_SIZE:
+                zinfo_, future = pending.popleft()
+                pending_size -= zinfo_.file_size
+                _write_compressed(ziph, zinfo_, *future.result())
+        while pending:
+            zinfo_, future = pending.popleft()
+            _write_compressed(ziph, zinfo_, *future.result())
 
 
 class CSARWriter(object):
@@ -42,10 +266,18 @@ class CSARWriter(object):
     :param str source: Path to the root directory to use
     :param str entry: Relative (from root directory) path to the definitions
                       entry file.
+    :param int compression: ZIP compression method (`zipfile.ZIP_STORED`
+                      trades size for speed)
+    :param int compresslevel: Compression level (as for `zipfile.ZipFile`),
+                      or None for the default level
+    :param bool validate: If True, reads the package back with a
+                      `CSARReader` (available as `reader`) to validate it.
+                      Otherwise `reader` is None.
     '''
     def __init__(self, source, entry='tosca_elk.yaml',
                  author='TOSCA', output='./build.csar.zip',
-                 logger=None):
+                 logger=None, validate=True,
+                 compression=zipfile.ZIP_DEFLATED, compresslevel=None):
         self.log = logger or logging.getLogger('csar.writer')
         self.log.debug('CSARWriter(%s, %s)', source, entry)
         self.csar = {
@@ -55,8 +287,15 @@ class CSARWriter(object):
             'entry': entry,
             # Working CSAR data
             'local': None,
+            # Working CSAR archive, left open for create_metadata
+            'ziph': None,
             # Final CSAR file destination path
             'destination': output,
+            # ZIP compression method and level
+            'compression': compression,
+            'compresslevel': compresslevel,
+            # Last calculated signature, as (package and key id, digest)
+            'signature': None,
             # Working metadata
             'metadata': {
                 'TOSCA-Meta-File-Version': '1.0',
@@ -67,16 +306,17 @@ class CSARWriter(object):
         }
         self._validate_pre()
         # ZIPs the contents if a directory was provided
-        # copies ZIP file if a non-CSAR ZIP file was provided
+        # copies ZIP file (to the destination) if a non-CSAR ZIP file
+        # was provided
         self._zip()
         # Create metadata file
         self.create_metadata()
         # Move the archive to the user-specified destination
-        self.log.debug('Copying CSAR to destination path: %s'
-                       % self.archive)
-        shutil.copy(self.csar['local'], self.archive)
+        self._move()
         # Validate non-CSAR data
-        self.reader = CSARReader(self.archive)
+        self.reader = None
+        if validate:
+            self.reader = CSARReader(self.archive)
 
     @property
     def archive(self):
@@ -119,32 +359,78 @@ class CSARWriter(object):
         '''
             Creates, or copies, a ZIP file of the non-CSAR data
         '''
+        is_zip = os.path.isfile(self.csar['source']) and \
+            self.csar['source'].endswith('.zip')
+        # Copy ZIP to ZIP (straight to the destination, unless the
+        # destination is the source; that goes through a temporary file
+        # which then replaces it)
+        if is_zip and not (os.path.exists(self.archive) and
+                           os.path.samefile(self.csar['source'],
+                                            self.archive)):
+            self.log.debug('Copying ZIP file from "%s" to "%s"',
+                           self.csar['source'], self.archive)
+            shutil.copy(self.csar['source'], self.archive)
+            # Update the CSAR definition
+            self.csar['local'] = self.archive
+            return
         # Get a temporary file
         self.log.debug('Generating temporary file')
         tmp_hndl, tmp_filename = mkstemp('.csar.zip')
         self.log.debug('Temporary file is: %s', tmp_filename)
         os.close(tmp_hndl)
-        # Copy ZIP to ZIP
-        if os.path.isfile(self.csar['source']) and \
-           self.csar['source'].endswith('.zip'):
-            self.log.debug('Copying ZIP file from "%s" to "%s"' % (
-                self.csar['source'], tmp_filename))
-            shutil.copy(self.csar['source'], tmp_filename)
-        elif os.path.isdir(self.csar['source']):
-            self.log.debug('Compressing root directory to ZIP')
-            ziph = zipfile.ZipFile(tmp_filename, 'w', zipfile.ZIP_DEFLATED)
-            for _root, _dirs, files in os.walk(self.csar['source']):
-                for _file in files:
-                    self.log.debug('Writing to archive: %s',
-                                   os.path.relpath(os.path.join(_root, _file),
-                                                   self.csar['source']))
-                    ziph.write(os.path.join(_root, _file),
-                               os.path.relpath(os.path.join(_root, _file),
-                                               self.csar['source']))
-            ziph.close()
+        ziph = None
+        try:
+            if is_zip:
+                self.log.debug('Copying ZIP file from "%s" to "%s"',
+                               self.csar['source'], tmp_filename)
+                shutil.copy(self.csar['source'], tmp_filename)
+            elif os.path.isdir(self.csar['source']):
+                self.log.debug('Compressing root directory to ZIP')
+                ziph = zipfile.ZipFile(
+                    tmp_filename, 'w', self.csar['compression'],
+                    compresslevel=self.csar['compresslevel'])
+                members = list()
+                debug = self.log.isEnabledFor(logging.DEBUG)
+                for path, arcname in _walk_files(self.csar['source']):
+                    if debug:
+                        self.log.debug('Writing to archive: %s', arcname)
+                    members.append((path, arcname))
+                # Deflate the files concurrently
+                _zip_files(ziph, members)
+        except BaseException:
+            # Don't leave a half-written archive open or on disk
+            if ziph is not None:
+                try:
+                    ziph.close()
+                except Exception:
+                    pass
+            os.remove(tmp_filename)
+            raise
+        if ziph is not None:
+            # Left open for the metadata file to be added
+            self.csar['ziph'] = ziph
         # Update the CSAR definition
         self.csar['local'] = tmp_filename
 
+    def _move(self):
+        '''
+            Moves the working archive to the destination path. This is a
+            rename unless the destination is on another filesystem.
+        '''
+        if self.csar['local'] == self.archive:
+            return
+        self.log.debug('Moving CSAR to destination path: %s', self.archive)
+        try:
+            os.replace(self.csar['local'], self.archive)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            self.log.debug('Destination is on another filesystem; copying')
+            shutil.copy(self.csar['local'], self.archive)
+            os.remove(self.csar['local'])
+        # Update the CSAR definition
+        self.csar['local'] = self.archive
+
     def _validate_pre(self):
         '''
             Validates a proposed CSAR package (before ZIP)
@@ -157,13 +443,53 @@ class CSARWriter(object):
         '''
             Creates a new TOSCA CSAR metadata file
         '''
-        self.log.debug('Opening archive for updating')
-        ziph = zipfile.ZipFile(self.csar['local'], 'a', zipfile.ZIP_DEFLATED)
-        self.log.debug('Writing new metadata file to %s'
-                       % constants.META_FILE)
-        ziph.writestr(constants.META_FILE,
-                      yaml.dump(self.metadata, default_flow_style=False))
-        ziph.close()
+        # Reuse the archive if it is still open from being built
+        ziph = self.csar['ziph']
+        self.csar['ziph'] = None
+        if ziph is None:
+            self.log.debug('Opening archive for updating')
+            ziph = zipfile.ZipFile(self.csar['local'], 'a',
+                                   self.csar['compression'],
+                                   compresslevel=self.csar['compresslevel'])
+        with ziph:
+            self.log.debug('Writing new metadata file to %s',
+                           constants.META_FILE)
+            # Flat metadata is formatted by hand, in declaration order
+            metafile = _format_meta(self.metadata)
+            if metafile is None:
+                metafile = yaml.dump(self.metadata, Dumper=YAMLDumper,
+                                     default_flow_style=False)
+            # Stored: deflating a few hundred bytes costs more than it saves
+            ziph.writestr(constants.META_FILE, metafile,
+                          compress_type=zipfile.ZIP_STORED)
+
+    def _open_archive(self):
+        '''Opens the CSAR package for reading'''
+        if not self.csar['destination']:
+            raise RuntimeError(
+                'Cannot calculate signature before CSAR package exists')
+        self.log.debug('Using CSAR package at "%s"', self.csar['destination'])
+        return open(self.csar['destination'], 'rb', buffering=0)
+
+    @staticmethod
+    def _calculate_signature(fcsar, keydata):
+        '''
+            Calculates the signature of an open CSAR package, always
+            hashing its contents
+
+        :param file fcsar: CSAR package, opened for binary reading
+        :param str keydata: Key signing data
+        :rtype: str
+        :returns: Signature string
+        '''
+        def sig_factory():
+            return hmac.new(keydata, digestmod=hashlib.sha384)
+        # Python 3.11+ hashes into a single reusable buffer
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(fcsar, sig_factory).hexdigest()
+        sig_builder = sig_factory()
+        _update_from_file(sig_builder, fcsar)
+        return sig_builder.hexdigest()
 
     def create_signature(self, keydata, outfile=None):
         '''
@@ -175,26 +501,21 @@ class CSARWriter(object):
         :rtype: str
         :returns: Signature string
         '''
-        sig_builder = hmac.new(keydata, digestmod=hashlib.sha384)
-        # Open the CSAR for reading
-        if not self.csar['destination']:
-            raise RuntimeError(
-                'Cannot calculate signature before CSAR package exists')
-        fcsar = open(self.csar['destination'], 'rb')
-        # Read in chunks and prepare for signature calculation
-        self.log.debug('Using CSAR package at "%s"',self.csar['destination'])
         self.log.debug('Preparing to calculate CSAR signature')
-        try:
-            while True:
-                block = fcsar.read(4096)
-                if not block:
-                    break
-                sig_builder.update(block)
-        finally:
-            fcsar.close()
-        # Get the actual signature
-        self.log.debug('Calculating CSAR signature')
-        digest = sig_builder.hexdigest()
+        with self._open_archive() as fcsar:
+            # Identify the package contents and key, so the signature
+            # of an unchanged package is not calculated twice
+            fstat = os.fstat(fcsar.fileno())
+            sig_id = (fstat.st_ino, fstat.st_mtime_ns, fstat.st_size,
+                      hashlib.blake2b(keydata, digest_size=16).digest())
+            if self.csar['signature'] and \
+               self.csar['signature'][0] == sig_id:
+                self.log.debug('Using previously calculated CSAR signature')
+                digest = self.csar['signature'][1]
+            else:
+                self.log.debug('Calculating CSAR signature')
+                digest = self._calculate_signature(fcsar, keydata)
+                self.csar['signature'] = (sig_id, digest)
         self.log.debug('Calculated CSAR signature as "%s"', digest)
         # Write signature to file if needed
         if outfile:
@@ -204,7 +525,8 @@ class CSARWriter(object):
         # Return the signature
         return digest
 
-    def verify_signature(self, keydata, digest=None, sigfile=None):
+    def verify_signature(self, keydata, digest=None, sigfile=None,
+                         precomputed_digest=None):
         '''
             Verifies a signature for the CSAR package
 
@@ -212,8 +534,11 @@ class CSARWriter(object):
             If both are specified, `digest` takes precedence.
 
         :param str keydata: Key signing data
-        :param str digest: Signature string
+        :param digest: Signature string (str or ASCII bytes)
         :param str sigfile: Path to a signature file
+        :param precomputed_digest: Signature of the CSAR package (str or
+            ASCII bytes), as returned by `create_signature` for the same
+            key. If set, the package is not hashed again.
         :rtype: boolean
         :returns: True if signature is verified, False if not
         '''
@@ -225,15 +550,26 @@ class CSARWriter(object):
             self.log.debug('Using signature from string')
         elif sigfile:
             self.log.debug('Using signature from file "%s"', sigfile)
-            with open(sigfile, 'r') as sfile:
+            with open(sigfile, 'rb') as sfile:
                 digest = sfile.read()
-        # Signature normalization
-        if not isinstance(digest, basestring):
+        # Signature normalization (compared as bytes)
+        if isinstance(digest, str):
+            digest = digest.encode('ascii', 'replace')
+        elif not isinstance(digest, bytes):
             raise RuntimeError('Existing signature must be a string type')
         digest = digest.strip()
-        # Calculate fresh signature
-        real_digest = self.create_signature(keydata)
+        # Calculate fresh signature (unless the caller already has). The
+        # package is always hashed; its stat can be restored after tampering
+        real_digest = precomputed_digest
+        if not real_digest:
+            with self._open_archive() as fcsar:
+                self.log.debug('Calculating CSAR signature')
+                real_digest = self._calculate_signature(fcsar, keydata)
+        if isinstance(real_digest, str):
+            real_digest = real_digest.encode('ascii', 'replace')
+        elif not isinstance(real_digest, bytes):
+            raise RuntimeError('Precomputed signature must be a string type')
         # Verify signatures
-        return hmac.compare_digest(digest, real_digest)
+        return hmac.compare_digest(digest, real_digest.strip())
 
 
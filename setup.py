@@ -14,7 +14,51 @@
 #    * limitations under the License.
 '''NFV-O packager utility config'''
 
+import logging
 from setuptools import setup
+from setuptools.command.build_ext import build_ext
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
+# Hot validation and packaging modules compiled to C when Cython is
+# available. The pure Python sources are always installed and used as
+# a fallback.
+CYTHON_MODULES = [
+    'nfvo_packager/reader.py',
+    'nfvo_packager/writer.py'
+]
+
+
+class OptionalBuildExt(build_ext):
+    '''Builds C extensions, but never fails the install if it can't'''
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as exc:
+            self.warn('Skipping optional C extensions: %s' % exc)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as exc:
+            self.warn('Skipping optional C extension %s: %s' % (
+                ext.name, exc))
+
+
+def optional_ext_modules():
+    '''Translates CYTHON_MODULES to C, or returns no modules if it can't'''
+    if not cythonize:
+        return []
+    try:
+        return cythonize(CYTHON_MODULES, quiet=True,
+                         compiler_directives={'language_level': 3})
+    except Exception as exc:
+        logging.warning('Skipping optional C extensions: %s', exc)
+        return []
+
 
 setup(
     name='nfvo-packager',
@@ -26,5 +70,13 @@ setup(
     description='NFV-O packager utility',
     install_requires=[
         'pyyaml',
-    ]
+    ],
+    extras_require={
+        # ISA-L accelerated Deflate for CSARWriter
+        'isal': ['isal']
+    },
+    ext_modules=optional_ext_modules(),
+    cmdclass={
+        'build_ext': OptionalBuildExt
+    }
 )
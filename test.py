@@ -1,6 +1,7 @@
 #!/usr/bin/python
 '''Test application'''
 
+import logging
 import os
 from aria import install_aria_extensions
 from aria.consumption import (
@@ -11,6 +12,7 @@ from aria.loading import LiteralLocation
 
 from nfvo_packager.writer import CSARReader, CSARWriter
 
+logging.basicConfig(level=logging.DEBUG)
 install_aria_extensions()
 
 
@@ -32,11 +34,11 @@ def parse_text(payload, search_paths=None):
 
 def dump_info(csar):
     '''Dumps information from a CSAR reader'''
-    print 'Path: %s' % csar.path
-    print 'Author: %s' % csar.author
-    print 'Version: %s' % csar.version
-    print 'Metadata file version: %s' % csar.metadata_file_version
-    print 'Entry definitions: %s' % csar.entry_definitions
+    print('Path: %s' % csar.path)
+    print('Author: %s' % csar.author)
+    print('Version: %s' % csar.version)
+    print('Metadata file version: %s' % csar.metadata_file_version)
+    print('Entry definitions: %s' % csar.entry_definitions)
 
     # Send the package to ARIA for parsing
     # Including the /definitions directory for searching
@@ -45,33 +47,33 @@ def dump_info(csar):
         [os.path.join(csar.path, 'definitions')])
     # Dump information about the final blueprint
     for _, node in aria_res.nodes.items():
-        print '\nNode: %s:' % node.id
-        print '| type: %s' % node.type_name
-        print '| template: %s' % node.template_name
-        print '| properties:'
+        print('\nNode: %s:' % node.id)
+        print('| type: %s' % node.type_name)
+        print('| template: %s' % node.template_name)
+        print('| properties:')
         for pname, prop in node.properties.items():
-            print '  | %s: %s' % (pname, prop.value)
-        print '| capabilities:'
+            print('  | %s: %s' % (pname, prop.value))
+        print('| capabilities:')
         for _, capability in node.capabilities.items():
-            print '  | %s:' % capability.name
+            print('  | %s:' % capability.name)
             for pname, prop in capability.properties.items():
-                print '    | %s: %s' % (pname, prop.value)
+                print('    | %s: %s' % (pname, prop.value))
 
 
 def main():
     '''Entry point'''
-    print '\n\n======================='
-    print '== VNF CHAINING CSAR =='
-    print '======================='
+    print('\n\n=======================')
+    print('== VNF CHAINING CSAR ==')
+    print('=======================')
     build = CSARWriter('examples/csar_vnf_chaining',
                        entry='service.yaml',
                        author='Gigaspaces',
                        output='examples/csar_vnf_chaining.zip')
     dump_info(build.reader)
     
-    print '\n\n==================================='
-    print '== HELLO WORLD CSAR W/ ARTIFACTS =='
-    print '==================================='
+    print('\n\n===================================')
+    print('== HELLO WORLD CSAR W/ ARTIFACTS ==')
+    print('===================================')
     dump_info(CSARReader('examples/csar_hello_world.zip'))
 
 
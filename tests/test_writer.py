@@ -0,0 +1,118 @@
+'''
+    Tests for the CSAR writer's ZIP output
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from nfvo_packager import writer
+from nfvo_packager.writer import CSARWriter
+
+
+ENTRY = 'definitions/tosca_elk.yaml'
+
+
+class CSARWriterZipTest(unittest.TestCase):
+    '''Builds CSARs from a directory and checks the archived members'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'source')
+        self.output = os.path.join(self.tmpdir, 'build.csar.zip')
+        self.files = {
+            ENTRY: b'tosca_definitions_version: tosca_simple_yaml_1_0\n',
+            # Deflated, concurrently
+            'scripts/configure.sh': b'#!/bin/sh\necho configure\n' * 64,
+            # Stored, by extension
+            'images/vdu.tar.gz': os.urandom(4096),
+            # Streamed (larger than the patched PARALLEL_DEFLATE_MAX_SIZE)
+            'blobs/large.blob': b'0123456789abcdef' * 4096,
+            # Non-ASCII member name
+            u'données/été.txt': u'été\n'.encode(),
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.source, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fhndl:
+                fhndl.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_members(self):
+        '''Every source file is archived intact'''
+        with mock.patch.object(writer, 'PARALLEL_DEFLATE_MAX_SIZE', 1024):
+            CSARWriter(self.source, entry=ENTRY, output=self.output,
+                       validate=False)
+        with zipfile.ZipFile(self.output) as zfile:
+            self.assertIsNone(zfile.testzip())
+            for name, data in self.files.items():
+                self.assertEqual(zfile.read(name), data)
+            self.assertEqual(zfile.getinfo('images/vdu.tar.gz').compress_type,
+                             zipfile.ZIP_STORED)
+            self.assertEqual(zfile.getinfo('blobs/large.blob').compress_type,
+                             zipfile.ZIP_DEFLATED)
+            self.assertIn('TOSCA-Metadata/TOSCA.meta', zfile.namelist())
+
+    def test_failure_cleanup(self):
+        '''A failed compression leaves no temporary archive behind'''
+        tmp_filenames = list()
+
+        def _mkstemp(*args, **kwargs):
+            tmp = tempfile.mkstemp(*args, **kwargs)
+            tmp_filenames.append(tmp[1])
+            return tmp
+
+        with mock.patch.object(writer, 'mkstemp', _mkstemp), \
+                mock.patch.object(writer, '_zip_files',
+                                  side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                CSARWriter(self.source, entry=ENTRY, output=self.output,
+                           validate=False)
+        self.assertEqual(len(tmp_filenames), 1)
+        self.assertFalse(os.path.exists(tmp_filenames[0]))
+        self.assertFalse(os.path.exists(self.output))
+
+
+class CSARWriterSignatureTest(unittest.TestCase):
+    '''Signs and verifies a CSAR package'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csar = CSARWriter(
+            os.path.join(os.path.dirname(__file__), os.pardir, 'examples',
+                         'csar_hello_world_nometa'),
+            entry=ENTRY, output=os.path.join(self.tmpdir, 'build.csar.zip'),
+            validate=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_verify(self):
+        '''A signature verifies against its own package and key only'''
+        digest = self.csar.create_signature(b'key')
+        self.assertEqual(self.csar.create_signature(b'key'), digest)
+        self.assertTrue(self.csar.verify_signature(b'key', digest=digest))
+        self.assertTrue(self.csar.verify_signature(
+            b'key', digest=digest.encode(), precomputed_digest=digest))
+        self.assertFalse(self.csar.verify_signature(b'other', digest=digest))
+
+    def test_verify_tampered(self):
+        '''Tampering is detected even with the file stat restored'''
+        digest = self.csar.create_signature(b'key')
+        fstat = os.stat(self.csar.archive)
+        with open(self.csar.archive, 'r+b') as fcsar:
+            fcsar.seek(-1, os.SEEK_END)
+            last = fcsar.read(1)
+            fcsar.seek(-1, os.SEEK_END)
+            fcsar.write(bytes((last[0] ^ 0xff,)))
+        os.utime(self.csar.archive,
+                 ns=(fstat.st_atime_ns, fstat.st_mtime_ns))
+        self.assertFalse(self.csar.verify_signature(b'key', digest=digest))
+
+
+if __name__ == '__main__':
+    unittest.main()